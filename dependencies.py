@@ -1,16 +1,29 @@
 from dotenv import load_dotenv
 load_dotenv() 
 import hashlib
+import hmac
+import logging
+import blake3
 import jwt
 import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
+from typing import List, Optional
 import google.generativeai as genai
 from supabase import create_client, Client
 import io
 from PIL import Image
-import PyPDF2
-from docx import Document
+import fitz
+import zipfile
+from lxml import etree
 import filetype 
+from pdf_extraction import extract_pdf_pages, worker_ready
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
 
 # Supabase configuration
 SUPABASE_URL = os.environ.get('SUPABASE_URL')
@@ -25,6 +38,7 @@ if not SECRET_KEY:
     raise RuntimeError("SECRET_KEY must be set in environment variables.")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+JWT_CACHE_ENABLED = os.environ.get('JWT_CACHE_ENABLED', '').lower() in ('1', 'true', 'yes')
 
 # Initialize Gemini AI with your API key
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
@@ -33,13 +47,58 @@ if not GEMINI_API_KEY:
 genai.configure(api_key=GEMINI_API_KEY)
 model = genai.GenerativeModel('gemini-2.5-flash')
 
+# Retrieval configuration
+EMBEDDING_MODEL = 'models/text-embedding-004'
+EMBEDDING_BATCH_SIZE = 100  # also the number of document_chunks rows per insert
+CHUNK_SIZE = 2000  # characters, roughly 500 tokens
+CHUNK_OVERLAP = 200
+CONTEXT_CHUNKS = 8
+
+# Leading text of extract_text_from_file's failure notices
+EXTRACTION_NOTICE_PREFIXES = ('[Error', '[Unsupported file type:', '[Legacy Word document (.doc) detected.')
+
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'tiff']
+TEXT_EXTENSIONS = ['txt', 'md', 'csv', 'json', 'xml', 'html', 'htm', 'rtf']
+# Extensions that select an extraction branch on their own, without sniffing the content
+KNOWN_EXTENSIONS = {'pdf', 'docx', 'doc', *TEXT_EXTENSIONS, *IMAGE_EXTENSIONS}
+
+# WordprocessingML element tags
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+W_P, W_T, W_TAB = W_NS + 'p', W_NS + 't', W_NS + 'tab'
+W_BR, W_CR, W_TYPE = W_NS + 'br', W_NS + 'cr', W_NS + 'type'
+MC_FALLBACK = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'
+# Content of a paragraph's own runs (direct and hyperlinked), excluding nested text-box paragraphs
+W_RUN_CONTENT = etree.XPath('./w:r/* | ./w:hyperlink/w:r/*', namespaces={'w': W_NS[1:-1]})
+
+# PDFs with at least this many pages are split across worker processes. Measured with PyMuPDF:
+# ~2ms per text-dense page, and ~15ms (small file) to ~175ms (10MB file) to ship the bytes to
+# 8 workers. The pool is started with the app (~1s of spawning and importing fitz), so requests
+# only pay the transfer: at 256 pages a 10MB PDF takes ~240ms pooled versus ~510ms serially.
+PARALLEL_PDF_MIN_PAGES = 256
+# CPUs this process may run on (not the host's core count); override with PDF_WORKERS, 1 disables the pool.
+_available_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', min(8, _available_cpus)))
+_pdf_executor = None
+_pdf_executor_lock = threading.Lock()
+
+# Per-process cache of image OCR results, backed by the image_ocr_cache table
+_image_text_cache = LRUCache(maxsize=512)
+_image_text_cache_lock = threading.Lock()
+
 # Functions 
 
+BLAKE3_PREFIX = "b3$"
+
 def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+    return BLAKE3_PREFIX + blake3.blake3(password.encode()).hexdigest()
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return hash_password(plain_password) == hashed_password
+    # Hashes without the prefix are legacy SHA-256 digests from before the switch to BLAKE3.
+    if hashed_password.startswith(BLAKE3_PREFIX):
+        candidate = hash_password(plain_password)
+    else:
+        candidate = hashlib.sha256(plain_password.encode()).hexdigest()
+    return hmac.compare_digest(candidate, hashed_password)
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
@@ -51,20 +110,93 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def get_pdf_executor() -> ProcessPoolExecutor:
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is None:
+            _pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pdf_executor
+
+def start_pdf_workers():
+    """Spawns the PDF worker pool up front so the first large PDF doesn't pay for it."""
+    if PDF_WORKERS >= 2:
+        executor = get_pdf_executor()
+        wait([executor.submit(worker_ready) for _ in range(PDF_WORKERS)])
+
+def extract_pdf_pages_in_pool(file_content: bytes, page_count: int) -> List[str]:
+    """Extracts page ranges in the worker pool. A pool broken by a crashed worker is discarded so
+    the next PDF gets a fresh one; this PDF is not retried in-process, since it likely caused the crash."""
+    global _pdf_executor
+    executor = get_pdf_executor()
+    step = -(-page_count // PDF_WORKERS)
+    try:
+        futures = [
+            executor.submit(extract_pdf_pages, file_content, start, min(start + step, page_count))
+            for start in range(0, page_count, step)
+        ]
+        return [page_text for future in futures for page_text in future.result()]
+    except BrokenProcessPool:
+        logger.warning("PDF worker pool is broken; discarding it")
+        with _pdf_executor_lock:
+            if _pdf_executor is executor:
+                _pdf_executor = None
+        executor.shutdown(wait=False)
+        raise
+
+def extract_image_text(file_content: bytes) -> str:
+    """Gemini image OCR, cached by the SHA-256 of the image bytes."""
+    digest = hashlib.sha256(file_content).hexdigest()
+    with _image_text_cache_lock:
+        text = _image_text_cache.get(digest)
+    if text is not None:
+        return text
+
+    # The shared cache is best-effort: a failed lookup falls through to Gemini, a failed write still returns the text.
+    try:
+        cache_res = supabase.table("image_ocr_cache").select("text").eq("hash", digest).execute()
+        text = cache_res.data[0]["text"] if cache_res.data else None
+    except Exception as e:
+        logger.warning("Image OCR cache lookup failed: %s", e)
+    if text is None:
+        image = Image.open(io.BytesIO(file_content))
+        prompt = "Extract all text from this image. If no text is present, briefly describe the image content."
+        response = model.generate_content([prompt, image])
+        text = response.text
+        try:
+            supabase.table("image_ocr_cache").upsert({"hash": digest, "text": text}, ignore_duplicates=True).execute()
+        except Exception as e:
+            logger.warning("Image OCR cache write failed: %s", e)
+
+    with _image_text_cache_lock:
+        _image_text_cache[digest] = text
+    return text
+
 def extract_text_from_file(file_content: bytes, filename: str) -> str:
     """Text extraction function using the 'filetype' library."""
     try:
-        kind = filetype.guess(file_content)
-        file_type = kind.mime if kind else 'application/octet-stream'
         file_extension = filename.lower().split('.')[-1] if '.' in filename else ''
+        if file_extension in KNOWN_EXTENSIONS:
+            file_type = 'application/octet-stream'
+        else:
+            kind = filetype.guess(file_content)
+            file_type = kind.mime if kind else 'application/octet-stream'
 
         if file_type == 'application/pdf' or file_extension == 'pdf':
             try:
-                pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
+                doc = fitz.open(stream=file_content, filetype="pdf")
+                try:
+                    page_count = doc.page_count
+                    if page_count < PARALLEL_PDF_MIN_PAGES or PDF_WORKERS < 2:
+                        page_texts = [page.get_text("text") for page in doc]
+                finally:
+                    doc.close()
+
+                if page_count >= PARALLEL_PDF_MIN_PAGES and PDF_WORKERS >= 2:
+                    page_texts = extract_pdf_pages_in_pool(file_content, page_count)
+
                 text_parts = []
-                for i, page in enumerate(pdf_reader.pages):
-                    page_text = page.extract_text()
-                    if page_text and page_text.strip():
+                for i, page_text in enumerate(page_texts):
+                    if page_text and not page_text.isspace():
                         text_parts.append(f"\n--- Page {i + 1} ---\n{page_text}\n")
                 return "".join(text_parts).strip()
             except Exception as e:
@@ -73,16 +205,26 @@ def extract_text_from_file(file_content: bytes, filename: str) -> str:
         elif (file_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document' or
               file_extension == 'docx'):
             try:
-                doc = Document(io.BytesIO(file_content))
+                with zipfile.ZipFile(io.BytesIO(file_content)) as docx:
+                    root = etree.fromstring(docx.read('word/document.xml'))
+                # Word writes each text box twice (mc:Choice and a VML mc:Fallback copy); keep one.
+                for fallback in list(root.iter(MC_FALLBACK)):
+                    fallback.getparent().remove(fallback)
+                # Body, table-cell and text-box paragraphs in document order, each from its own runs
                 full_text = []
-                for para in doc.paragraphs:
-                    if para.text.strip():
-                        full_text.append(para.text)
-                for table in doc.tables:
-                    for row in table.rows:
-                        for cell in row.cells:
-                            if cell.text.strip():
-                                full_text.append(cell.text)
+                for p in root.iter(W_P):
+                    parts = []
+                    for el in W_RUN_CONTENT(p):
+                        if el.tag == W_T:
+                            parts.append(el.text or '')
+                        elif el.tag == W_TAB:
+                            parts.append('\t')
+                        elif el.tag == W_CR or (el.tag == W_BR and el.get(W_TYPE, 'textWrapping') == 'textWrapping'):
+                            # Page and column breaks add no text, matching python-docx.
+                            parts.append('\n')
+                    t = ''.join(parts)
+                    if t and not t.isspace():
+                        full_text.append(t)
                 return '\n'.join(full_text).strip()
             except Exception as e:
                 return f"[Error reading Word document: {str(e)}]"
@@ -91,7 +233,7 @@ def extract_text_from_file(file_content: bytes, filename: str) -> str:
             return f"[Legacy Word document (.doc) detected. Please convert to .docx format for better text extraction. Filename: {filename}]"
 
         elif (file_type.startswith('text/') or
-              file_extension in ['txt', 'md', 'csv', 'json', 'xml', 'html', 'htm', 'rtf']):
+              file_extension in TEXT_EXTENSIONS):
             try:
                 return file_content.decode('utf-8')
             except UnicodeDecodeError:
@@ -100,13 +242,9 @@ def extract_text_from_file(file_content: bytes, filename: str) -> str:
                 return f"[Error reading text file: {str(e)}]"
 
         elif (file_type.startswith('image/') or
-              file_extension in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'tiff']):
+              file_extension in IMAGE_EXTENSIONS):
             try:
-                vision_model = genai.GenerativeModel('gemini-1.5-flash')
-                image = Image.open(io.BytesIO(file_content))
-                prompt = "Extract all text from this image. If no text is present, briefly describe the image content."
-                response = vision_model.generate_content([prompt, image])
-                return f"[Image content from {filename}]\n{response.text}"
+                return f"[Image content from {filename}]\n{extract_image_text(file_content)}"
             except Exception as e:
                 return f"[Image content from {filename} - Vision processing error: {str(e)}]"
 
@@ -116,6 +254,82 @@ def extract_text_from_file(file_content: bytes, filename: str) -> str:
     except Exception as e:
         return f"[Error extracting text from {filename}: {str(e)}]"
 
+def chunk_text(text: str) -> List[str]:
+    """Splits text into overlapping chunks of about CHUNK_SIZE characters."""
+    chunks = []
+    start = 0
+    while start < len(text):
+        chunk = text[start:start + CHUNK_SIZE]
+        if chunk.strip():
+            chunks.append(chunk)
+        start += CHUNK_SIZE - CHUNK_OVERLAP
+    return chunks
+
+def embed_texts(texts: List[str], task_type: str) -> List[List[float]]:
+    """Embeds texts with Gemini in batches."""
+    embeddings = []
+    for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=texts[i:i + EMBEDDING_BATCH_SIZE], task_type=task_type)
+        embeddings.extend(result['embedding'])
+    return embeddings
+
+def is_extraction_notice(text: str) -> bool:
+    """True when extract_text_from_file returned a failure notice instead of document text."""
+    newline = text.find('\n')
+    head = text if newline == -1 else text[:newline]
+    return (head.startswith(EXTRACTION_NOTICE_PREFIXES) or
+            (head.startswith('[Image content from ') and ' - Vision processing error: ' in head))
+
+def index_document(document_id: int, user_id: int, text: str):
+    """Chunks and embeds a document's text into document_chunks, then marks the document indexed.
+    Extraction failure notices get no chunks, so they are never served as chat context."""
+    chunks = [] if is_extraction_notice(text) else chunk_text(text)
+    try:
+        for start in range(0, len(chunks), EMBEDDING_BATCH_SIZE):
+            batch = chunks[start:start + EMBEDDING_BATCH_SIZE]
+            embeddings = embed_texts(batch, "retrieval_document")
+            supabase.table("document_chunks").insert([
+                {
+                    "document_id": document_id,
+                    "user_id": user_id,
+                    "chunk_index": start + i,
+                    "content": chunk,
+                    "embedding": embedding
+                }
+                for i, (chunk, embedding) in enumerate(zip(batch, embeddings))
+            ]).execute()
+    except Exception:
+        # Leave no partial index behind; the document stays unindexed and is used in full.
+        supabase.table("document_chunks").delete().eq("document_id", document_id).execute()
+        raise
+    supabase.table("documents").update({"indexed": True}).eq("id", document_id).execute()
+
+def search_document_chunks(user_id: int, query: str, document_ids: Optional[List[int]] = None) -> List[dict]:
+    """Returns the CONTEXT_CHUNKS chunks closest to the query, optionally limited to document_ids."""
+    query_embedding = embed_texts([query], "retrieval_query")[0]
+    res = supabase.rpc("match_document_chunks", {
+        "query_embedding": query_embedding,
+        "p_user_id": user_id,
+        "p_document_ids": document_ids,
+        "match_count": CONTEXT_CHUNKS
+    }).execute()
+    return res.data or []
+
+def warm_up_clients():
+    """Opens the Supabase and Gemini connections and starts the PDF workers ahead of the first request."""
+    try:
+        supabase.table("users").select("id").limit(1).execute()
+    except Exception as e:
+        logger.warning("Supabase warm-up failed: %s", e)
+    try:
+        model.count_tokens("ping")
+    except Exception as e:
+        logger.warning("Gemini warm-up failed: %s", e)
+    try:
+        start_pdf_workers()
+    except Exception as e:
+        logger.warning("PDF worker pool start failed: %s", e)
+
 def generate_response(message: str, context: str = "") -> str:
     """AI response generation function."""
     try:
@@ -0,0 +1,19 @@
+"""PDF page extraction for worker processes. Importing this module has no side effects, so spawned
+workers do not load the app's configuration, Supabase client or Gemini setup."""
+from typing import List
+
+import fitz
+
+
+def extract_pdf_pages(file_content: bytes, start: int, stop: int) -> List[str]:
+    """Text of pages [start, stop). Each call opens its own document since PyMuPDF objects are not thread-safe."""
+    doc = fitz.open(stream=file_content, filetype="pdf")
+    try:
+        return [doc[i].get_text("text") for i in range(start, stop)]
+    finally:
+        doc.close()
+
+
+def worker_ready() -> bool:
+    """No-op task used to start pool workers (and import fitz in them) ahead of the first PDF."""
+    return True
@@ -1,5 +1,10 @@
-import json
+import asyncio
+import hashlib
+import io
+import logging
 import secrets
+import threading
+import time
 from datetime import datetime
 from typing import List, Optional
 
@@ -7,13 +12,17 @@ from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel, EmailStr
 import jwt
+from cachetools import TTLCache
+from postgrest.types import ReturnMethod
 
 from dependencies import (
-    supabase, SECRET_KEY, ALGORITHM, create_access_token, hash_password,
-    verify_password, extract_text_from_file, generate_response
+    supabase, SECRET_KEY, ALGORITHM, JWT_CACHE_ENABLED, IMAGE_EXTENSIONS, create_access_token,
+    hash_password, verify_password, extract_text_from_file, generate_response, index_document,
+    search_document_chunks
 )
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 # Pydantic Models for Validation 
 class UserCreate(BaseModel):
@@ -45,15 +54,61 @@ class GuestChatRequest(BaseModel):
     context: Optional[str] = ""
     context_sources: Optional[List[dict]] = []
 
+# Uploads
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+async def read_upload(file: UploadFile) -> bytes:
+    """Reads an upload in chunks, aborting as soon as it exceeds MAX_UPLOAD_SIZE."""
+    buf = bytearray()
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        buf.extend(chunk)
+        if len(buf) > MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=400, detail="File size exceeds 10MB limit.")
+    return bytes(buf)
+
+# Chat context limits
+MAX_CONTEXT_DOCS = 50
+MAX_CONTEXT_CHARS = 200_000
+
+# Strong references to fire-and-forget tasks so they are not garbage-collected mid-flight
+_background_tasks = set()
+
+def _finish_background_task(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task failed", exc_info=task.exception())
+
+def run_in_background(func, *args):
+    """Runs a blocking call in a worker thread without making the request wait for it."""
+    task = asyncio.create_task(asyncio.to_thread(func, *args))
+    _background_tasks.add(task)
+    task.add_done_callback(_finish_background_task)
+    return task
+
 # Authentication
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login", auto_error=False)
 
+# Verified tokens, keyed by sha256(token) -> (user_id, exp). Short TTL bounds how long a revoked token stays usable.
+_token_cache = TTLCache(maxsize=10000, ttl=5)
+_token_cache_lock = threading.Lock()
+
 async def get_current_user_id(token: Optional[str] = Depends(oauth2_scheme)) -> int:
     if token is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Token is missing",
         )
+
+    if JWT_CACHE_ENABLED:
+        cache_key = hashlib.sha256(token.encode()).digest()
+        with _token_cache_lock:
+            cached = _token_cache.get(cache_key)
+        if cached and cached[1] > time.time():
+            return cached[0]
     
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -71,26 +126,25 @@ async def get_current_user_id(token: Optional[str] = Depends(oauth2_scheme)) ->
         )
     except jwt.PyJWTError:
         raise credentials_exception
+
+    if JWT_CACHE_ENABLED and "exp" in payload:
+        with _token_cache_lock:
+            _token_cache[cache_key] = (user_id, payload["exp"])
     
     return user_id
 
 @router.post("/auth/register", response_model=Token, status_code=status.HTTP_201_CREATED, tags=["Authentication"])
 async def register(user: UserCreate):
     try:
-        existing_user = supabase.table("users").select("id").eq("email", user.email).execute()
-        if existing_user.data:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
-
         hashed_pwd = hash_password(user.password)
-        new_user_res = supabase.table("users").insert({
-            "email": user.email,
-            "password_hash": hashed_pwd,
-            "full_name": user.full_name,
-            "created_at": datetime.utcnow().isoformat()
-        }).execute()
+        new_user_res = await asyncio.to_thread(supabase.rpc("register_user", {
+            "p_email": user.email,
+            "p_password_hash": hashed_pwd,
+            "p_full_name": user.full_name
+        }).execute)
         
         if not new_user_res.data:
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to create user")
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
         
         user_data = new_user_res.data[0]
         access_token = create_access_token(data={"user_id": user_data["id"]})
@@ -100,6 +154,8 @@ async def register(user: UserCreate):
             "token_type": "bearer",
             "user": user_data
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
@@ -107,7 +163,7 @@ async def register(user: UserCreate):
 @router.post("/auth/login", response_model=Token, tags=["Authentication"])
 async def login(form_data: UserLogin):
     try:
-        user_res = supabase.table("users").select("*").eq("email", form_data.email).execute()
+        user_res = await asyncio.to_thread(supabase.table("users").select("*").eq("email", form_data.email).execute)
         if not user_res.data:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
         
@@ -138,34 +194,59 @@ async def upload_file(
         
         filename = file.filename.lstrip("./\\")
 
-        file_content = await file.read()
+        file_content = await read_upload(file)
         file_size = len(file_content)
 
-        if file_size > 10 * 1024 * 1024:  # 10MB
-            raise HTTPException(status_code=400, detail="File size exceeds 10MB limit.")
-
         if not file_content:
             raise HTTPException(status_code=400, detail="Empty file uploaded.")
 
-        extracted_text = extract_text_from_file(file_content, filename)
-
-        extracted_text = extracted_text.replace('\x00', '')
-
-        warning_message = None
-        if extracted_text.startswith('[Error') or len(extracted_text.strip()) < 10:
-             warning_message = "Text extraction may have had issues. Please verify."
-
-        doc_res = supabase.table("documents").insert({
+        file_extension = filename.lower().split('.')[-1] if '.' in filename else ''
+        document_row = {
             "user_id": current_user_id,
             "filename": filename,
-            "content": extracted_text,
             "file_type": file.content_type or 'unknown',
             "created_at": datetime.utcnow().isoformat()
-        }).execute()
+        }
+
+        if file_extension in IMAGE_EXTENSIONS:
+            # Image OCR is a slow Gemini call, so overlap it with inserting a placeholder row.
+            extraction = asyncio.create_task(asyncio.to_thread(extract_text_from_file, file_content, filename))
+            try:
+                doc_res = await asyncio.to_thread(supabase.table("documents").insert({**document_row, "content": ""}).execute)
+            except Exception:
+                extraction.cancel()
+                raise
+            if not doc_res.data:
+                extraction.cancel()
+                raise HTTPException(status_code=500, detail="Failed to save document.")
+
+            document_id = doc_res.data[0]["id"]
+            try:
+                extracted_text = (await extraction).replace('\x00', '')
+                update_res = await asyncio.to_thread(supabase.table("documents").update({"content": extracted_text}).eq("id", document_id).execute)
+                if not update_res.data:
+                    raise HTTPException(status_code=500, detail="Failed to save document.")
+            except Exception:
+                # Don't leave an empty placeholder behind for an upload reported as failed.
+                try:
+                    await asyncio.to_thread(supabase.table("documents").delete().eq("id", document_id).execute)
+                except Exception as e:
+                    logger.warning("Removing placeholder document %s failed: %s", document_id, e)
+                raise
+        else:
+            extracted_text = (await asyncio.to_thread(extract_text_from_file, file_content, filename)).replace('\x00', '')
+            doc_res = await asyncio.to_thread(supabase.table("documents").insert({**document_row, "content": extracted_text}).execute)
         
         if not doc_res.data:
             raise HTTPException(status_code=500, detail="Failed to save document.")
 
+        warning_message = None
+        if extracted_text.startswith('[Error') or len(extracted_text.strip()) < 10:
+             warning_message = "Text extraction may have had issues. Please verify."
+
+        # Embedding can take dozens of API calls; until it finishes (or if it fails) chat uses the full content.
+        run_in_background(index_document, doc_res.data[0]["id"], current_user_id, extracted_text)
+
         response_data = {
             "message": "File uploaded successfully",
             "document_id": doc_res.data[0]["id"],
@@ -176,6 +257,8 @@ async def upload_file(
             "warning": warning_message
         }
         return response_data
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
@@ -183,10 +266,7 @@ async def upload_file(
 @router.get("/documents", tags=["Documents"])
 async def get_documents(current_user_id: int = Depends(get_current_user_id)):
     try:
-        documents_res = supabase.table("documents").select("id, filename, file_type, created_at, content").eq("user_id", current_user_id).order("created_at", desc=True).execute()
-        
-        for doc in documents_res.data:
-            doc["content_length"] = len(doc.pop("content", ""))
+        documents_res = await asyncio.to_thread(supabase.table("documents").select("id, filename, file_type, created_at, content_length").eq("user_id", current_user_id).order("created_at", desc=True).execute)
 
         return {"documents": documents_res.data}
     except Exception as e:
@@ -195,7 +275,7 @@ async def get_documents(current_user_id: int = Depends(get_current_user_id)):
 @router.get("/documents/{document_id}", tags=["Documents"])
 async def get_document_content(document_id: int, current_user_id: int = Depends(get_current_user_id)):
     try:
-        doc_res = supabase.table("documents").select("*").eq("id", document_id).eq("user_id", current_user_id).execute()
+        doc_res = await asyncio.to_thread(supabase.table("documents").select("*").eq("id", document_id).eq("user_id", current_user_id).execute)
         if not doc_res.data:
             raise HTTPException(status_code=404, detail="Document not found")
         return {"document": doc_res.data[0]}
@@ -205,12 +285,12 @@ async def get_document_content(document_id: int, current_user_id: int = Depends(
 @router.delete("/documents/{document_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Documents"])
 async def delete_document(document_id: int, current_user_id: int = Depends(get_current_user_id)):
     try:
-        verify_res = supabase.table("documents").select("id").eq("id", document_id).eq("user_id", current_user_id).execute()
-        if not verify_res.data:
+        delete_res = await asyncio.to_thread(supabase.table("documents").delete(returning=ReturnMethod.representation).eq("id", document_id).eq("user_id", current_user_id).execute)
+        if not delete_res.data:
              raise HTTPException(status_code=404, detail="Document not found")
-        
-        supabase.table("documents").delete().eq("id", document_id).eq("user_id", current_user_id).execute()
         return
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
@@ -221,31 +301,52 @@ async def chat(req: ChatRequest, current_user_id: int = Depends(get_current_user
     try:
         context = ""
         context_sources = []
-        query = supabase.table("documents").select("id, filename, content").eq("user_id", current_user_id)
-
-        if req.use_all_documents:
-            documents_res = query.execute()
-        elif req.selected_documents:
-            documents_res = query.in_("id", req.selected_documents).execute()
-        else:
-            documents_res = None
+        query = supabase.table("documents").select("id, filename, content").eq("user_id", current_user_id).order("created_at", desc=True)
+
+        chunks = []
+        documents = []
+        if req.use_all_documents or req.selected_documents:
+            document_ids = None if req.use_all_documents else req.selected_documents
+            try:
+                chunks = await asyncio.to_thread(search_document_chunks, current_user_id, req.message, document_ids)
+                # Documents uploaded before chunk indexing (or whose indexing failed) are sent in full.
+                query = query.eq("indexed", False)
+            except Exception as e:
+                logger.warning("Chunk search failed, using full document content: %s", e)
+            if document_ids is not None:
+                query = query.in_("id", document_ids)
+            else:
+                query = query.limit(MAX_CONTEXT_DOCS)
+            documents_res = await asyncio.to_thread(query.execute)
+            documents = documents_res.data or []
+
+        parts = [(chunk["document_id"], chunk["filename"], chunk["content"]) for chunk in chunks]
+        parts += [(doc["id"], doc["filename"], doc["content"]) for doc in documents]
+        if parts:
+            buf = io.StringIO()
+            remaining = MAX_CONTEXT_CHARS
+            seen_ids = set()
+            for doc_id, filename, content in parts:
+                part = f"--- Document: {filename} ---\n{content}"
+                if seen_ids:
+                    part = "\n\n" + part
+                buf.write(part[:remaining])
+                if doc_id not in seen_ids:
+                    seen_ids.add(doc_id)
+                    context_sources.append({"id": doc_id, "filename": filename})
+                remaining -= len(part)
+                if remaining <= 0:
+                    break
+            context = buf.getvalue()
         
-        if documents_res and documents_res.data:
-            context_parts = []
-            for doc in documents_res.data:
-                context_parts.append(f"--- Document: {doc['filename']} ---\n{doc['content']}")
-                context_sources.append({"id": doc["id"], "filename": doc["filename"]})
-            context = "\n\n".join(context_parts)
-        
-        response_text = generate_response(req.message, context)
+        response_text = await asyncio.to_thread(generate_response, req.message, context)
 
-        supabase.table("chat_history").insert({
+        run_in_background(supabase.table("chat_history").insert({
             "user_id": current_user_id,
             "message": req.message,
             "response": response_text,
-            "context_documents": json.dumps(context_sources),
-            "created_at": datetime.utcnow().isoformat()
-        }).execute()
+            "context_documents": context_sources
+        }).execute)
         
         return {
             "response": response_text,
@@ -259,7 +360,7 @@ async def chat(req: ChatRequest, current_user_id: int = Depends(get_current_user
 @router.get("/chat/history", tags=["Chat"])
 async def get_chat_history(current_user_id: int = Depends(get_current_user_id)):
     try:
-        history_res = supabase.table("chat_history").select("*").eq("user_id", current_user_id).order("created_at", desc=True).limit(50).execute()
+        history_res = await asyncio.to_thread(supabase.table("chat_history").select("*").eq("user_id", current_user_id).order("created_at", desc=True).limit(50).execute)
         return {"history": list(reversed(history_res.data))}
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
@@ -269,13 +370,10 @@ async def get_chat_history(current_user_id: int = Depends(get_current_user_id)):
 async def guest_extract_text(file: UploadFile = File(...)):
     try:
         filename = file.filename if file.filename else "uploaded_file"
-        file_content = await file.read()
+        file_content = await read_upload(file)
         file_size = len(file_content)
-
-        if file_size > 10 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File size exceeds 10MB limit.")
         
-        extracted_text = extract_text_from_file(file_content, filename)
+        extracted_text = await asyncio.to_thread(extract_text_from_file, file_content, filename)
         
         return {
             "extracted_text": extracted_text,
@@ -283,6 +381,8 @@ async def guest_extract_text(file: UploadFile = File(...)):
             "file_size": file_size,
             "extracted_length": len(extracted_text)
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
@@ -290,7 +390,7 @@ async def guest_extract_text(file: UploadFile = File(...)):
 @router.post("/guest/chat", tags=["Guest Mode"])
 async def guest_chat(req: GuestChatRequest):
     try:
-        response_text = generate_response(req.message, req.context)
+        response_text = await asyncio.to_thread(generate_response, req.message, req.context)
         return {
             "response": response_text,
             "context_used": bool(req.context),
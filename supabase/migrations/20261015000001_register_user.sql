@@ -0,0 +1,13 @@
+-- Single round-trip registration used by POST /api/auth/register.
+-- Returns no rows when the email is already taken (relies on the unique index on users.email).
+create unique index if not exists users_email_key on users (email);
+
+create or replace function register_user(p_email text, p_password_hash text, p_full_name text)
+returns table (id bigint, email text, full_name text)
+language sql
+as $$
+    insert into users (email, password_hash, full_name, created_at)
+    values (p_email, p_password_hash, p_full_name, now())
+    on conflict (email) do nothing
+    returning users.id, users.email, users.full_name;
+$$;
@@ -0,0 +1,3 @@
+-- Lets GET /api/documents list document sizes without downloading the content itself.
+alter table documents
+    add column if not exists content_length integer generated always as (char_length(content)) stored;
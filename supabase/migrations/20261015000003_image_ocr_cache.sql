@@ -0,0 +1,6 @@
+-- Gemini OCR results keyed by the hex SHA-256 of the uploaded image bytes.
+create table if not exists image_ocr_cache (
+    hash text primary key,
+    text text not null,
+    created_at timestamptz not null default now()
+);
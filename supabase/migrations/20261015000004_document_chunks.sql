@@ -0,0 +1,34 @@
+-- Embedded document chunks for top-k context retrieval in POST /api/chat.
+create extension if not exists vector;
+
+create table if not exists document_chunks (
+    id bigserial primary key,
+    document_id bigint not null references documents (id) on delete cascade,
+    user_id bigint not null,
+    chunk_index integer not null,
+    content text not null,
+    embedding vector(768) not null
+);
+
+create index if not exists document_chunks_embedding_idx
+    on document_chunks using hnsw (embedding vector_cosine_ops);
+create index if not exists document_chunks_user_id_idx on document_chunks (user_id);
+
+-- Nearest chunks to query_embedding among the user's documents (or only p_document_ids when given).
+create or replace function match_document_chunks(
+    query_embedding vector(768),
+    p_user_id bigint,
+    p_document_ids bigint[] default null,
+    match_count integer default 8
+)
+returns table (document_id bigint, filename text, content text, similarity double precision)
+language sql stable
+as $$
+    select c.document_id, d.filename, c.content, 1 - (c.embedding <=> query_embedding) as similarity
+    from document_chunks c
+    join documents d on d.id = c.document_id
+    where c.user_id = p_user_id
+      and (p_document_ids is null or c.document_id = any (p_document_ids))
+    order by c.embedding <=> query_embedding
+    limit match_count;
+$$;
@@ -0,0 +1,5 @@
+-- chat_history rows are inserted without a client timestamp, and context sources are sent as JSON, not a string.
+alter table chat_history alter column created_at set default now();
+alter table chat_history
+    alter column context_documents type jsonb using context_documents::jsonb,
+    alter column context_documents set default '[]'::jsonb;
@@ -0,0 +1,29 @@
+-- match_document_chunks: select the user's chunks before ordering by distance. An HNSW scan
+-- filtered afterwards only sees ~ef_search candidates from all users, so most users got fewer
+-- than match_count rows, or none. Per-user chunk counts are small enough for an exact scan.
+create index if not exists document_chunks_user_document_idx on document_chunks (user_id, document_id);
+
+create or replace function match_document_chunks(
+    query_embedding vector(768),
+    p_user_id bigint,
+    p_document_ids bigint[] default null,
+    match_count integer default 8
+)
+returns table (document_id bigint, filename text, content text, similarity double precision)
+language sql stable
+as $$
+    with user_chunks as materialized (
+        select c.document_id, c.content, c.embedding
+        from document_chunks c
+        where c.user_id = p_user_id
+          and (p_document_ids is null or c.document_id = any (p_document_ids))
+    )
+    select c.document_id, d.filename, c.content, 1 - (c.embedding <=> query_embedding) as similarity
+    from user_chunks c
+    join documents d on d.id = c.document_id
+    order by c.embedding <=> query_embedding
+    limit match_count;
+$$;
+
+-- Marks documents whose chunks are in document_chunks; chat sends the full content of the rest.
+alter table documents add column if not exists indexed boolean not null default false;
@@ -0,0 +1,3 @@
+-- Keep image_ocr_cache out of reach of the public anon key; only the backend's service key
+-- (which bypasses RLS) may read or write cached OCR text.
+alter table image_ocr_cache enable row level security;
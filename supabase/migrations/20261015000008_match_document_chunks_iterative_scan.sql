@@ -0,0 +1,31 @@
+-- match_document_chunks: use the HNSW index with pgvector >= 0.8 iterative scans instead of the
+-- exact per-user scan from 20261015000006. With iterative scanning the index keeps returning
+-- candidates until match_count rows survive the user/document filter, instead of stopping after
+-- ef_search candidates from all users. relaxed_order results are re-sorted by distance outside
+-- the materialized CTE.
+drop index if exists document_chunks_user_document_idx;
+create index if not exists document_chunks_document_id_idx on document_chunks (document_id);
+
+create or replace function match_document_chunks(
+    query_embedding vector(768),
+    p_user_id bigint,
+    p_document_ids bigint[] default null,
+    match_count integer default 8
+)
+returns table (document_id bigint, filename text, content text, similarity double precision)
+language sql stable
+set hnsw.iterative_scan = 'relaxed_order'
+as $$
+    with nearest as materialized (
+        select c.document_id, c.content, c.embedding <=> query_embedding as distance
+        from document_chunks c
+        where c.user_id = p_user_id
+          and (p_document_ids is null or c.document_id = any (p_document_ids))
+        order by c.embedding <=> query_embedding
+        limit match_count
+    )
+    select n.document_id, d.filename, n.content, 1 - n.distance as similarity
+    from nearest n
+    join documents d on d.id = n.document_id
+    order by n.distance;
+$$;
@@ -0,0 +1,3 @@
+-- Keep document_chunks (every user's document text) out of reach of the public anon key; only
+-- the backend's service key (which bypasses RLS) may read or write it.
+alter table document_chunks enable row level security;